@@ -87,8 +87,9 @@ async def subscribe_feed(url, name):
                 data = json.loads(message)
                 
                 if data.get('type') == 'L2_UPDATE':
-                    bids = f"{data['bids'][0]['price']} ({data['bids'][0]['quantity']})" if data['bids'] else "EMPTY"
-                    asks = f"{data['asks'][0]['price']} ({data['asks'][0]['quantity']})" if data['asks'] else "EMPTY"
+                    # Levels arrive as [price, quantity] pairs
+                    bids = f"{data['bids'][0][0]} ({data['bids'][0][1]})" if data['bids'] else "EMPTY"
+                    asks = f"{data['asks'][0][0]} ({data['asks'][0][1]})" if data['asks'] else "EMPTY"
                     print(f"--- {name} --- BBO: BIDS={bids} | ASKS={asks}")
                     
                 elif data.get('type') == 'TRADE_REPORT':
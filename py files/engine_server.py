@@ -1,20 +1,42 @@
 # engine_server.py
 import asyncio
+import itertools
 import json
+import signal
 import time
+from collections import deque
 
-from websockets.server import serve, WebSocketServerProtocol, broadcast
-from typing import Set, List, Dict
+import orjson
+
+from websockets.exceptions import ConnectionClosed
+from websockets.frames import Frame, Opcode
+from websockets.server import serve, WebSocketServerProtocol
+from typing import Deque, Set, List, Dict, Union
 from order_book import OrderBook
-from order_types import Order
+from order_types import Order, TICK, SIDES, ORDER_TYPES, is_whole_tick
 
 # --- Global State & Isolation (Persistence Integrated) ---
 # Load state on startup (BONUS #2)
 ORDER_BOOK = OrderBook.load_state(symbol="BTC-USDT") 
-ENGINE_QUEUE: asyncio.Queue = asyncio.Queue()
+# Handlers append to ENGINE_RING and set ENGINE_WAKE; the single engine loop
+# drains the ring in batches (no per-order Future like asyncio.Queue).
+ENGINE_RING: Deque[Order] = deque()
+ENGINE_WAKE = asyncio.Event()
+
+# Set by the engine whenever the book changes; l2_broadcaster coalesces
+# bursts within L2_COALESCE_WINDOW seconds into a single L2 snapshot.
+L2_DIRTY = asyncio.Event()
+L2_COALESCE_WINDOW = 0.001
 
-# Client subscription sets for real-time data
-MARKET_DATA_SUBSCRIBERS: Set[WebSocketServerProtocol] = set()
+# Full snapshots are written off-loop every SNAPSHOT_INTERVAL orders (BONUS #2)
+SNAPSHOT_INTERVAL = 1000
+
+# Client subscriptions for real-time data. Each market data client gets a
+# bounded queue drained by its own writer, so a slow reader only ever
+# holds the latest L2 snapshot instead of an ever-growing backlog.
+L2_QUEUE_SIZE = 1
+L2_FANOUT_BATCH = 64  # Subscribers served before yielding back to the event loop
+MARKET_DATA_SUBSCRIBERS: Dict[WebSocketServerProtocol, asyncio.Queue] = {}
 TRADE_SUBSCRIBERS: Set[WebSocketServerProtocol] = set()
 
 # --- 1. The Single-Threaded Core Loop ---
@@ -22,46 +44,135 @@ TRADE_SUBSCRIBERS: Set[WebSocketServerProtocol] = set()
 async def matching_engine_loop():
     """The heart of the system. Runs sequentially for strict FIFO processing."""
     print("Matching Engine Core Started: Waiting for Orders...")
+    loop = asyncio.get_running_loop()
+    orders_since_snapshot = 0
+    snapshot_future = None
     while True:
+        await ENGINE_WAKE.wait()
+        ENGINE_WAKE.clear()
+        batch_trades = []
+        while ENGINE_RING:
+            incoming_order = ENGINE_RING.popleft()
+            try:
+                trades = ORDER_BOOK.process_order(incoming_order)
+                if trades:
+                    batch_trades.append(trades)
+                orders_since_snapshot += 1
+
+            except Exception as e:
+                print(f"CRITICAL ENGINE ERROR: {e}")
+
+        # One WAL write per batch: orders reach the OS before their trades are published
         try:
-            incoming_order: Order = await ENGINE_QUEUE.get()
-            
-            trades = ORDER_BOOK.process_order(incoming_order)
-            
-            if trades:
-                await broadcast_trades(trades)
-                
-            await broadcast_order_book_update()
-            
-            ENGINE_QUEUE.task_done()
+            ORDER_BOOK.flush_wal()
+        except OSError as e:
+            print(f"CRITICAL WAL ERROR: {e}")
 
-        except Exception as e:
-            print(f"CRITICAL ENGINE ERROR: {e}")
+        for trades in batch_trades:
+            broadcast_trades(trades)
+        # No subscribers: skip waking the L2 broadcaster at all
+        if MARKET_DATA_SUBSCRIBERS:
+            L2_DIRTY.set()
+
+        # Snapshot last, so a persistence failure never holds back published trades.
+        # Capture is cheap and consistent here; pickling runs on a worker thread.
+        if orders_since_snapshot >= SNAPSHOT_INTERVAL and (snapshot_future is None or snapshot_future.done()):
+            try:
+                snapshot_future = loop.run_in_executor(None, OrderBook.write_snapshot, ORDER_BOOK.capture_snapshot())
+                snapshot_future.add_done_callback(report_snapshot_failure)
+                orders_since_snapshot = 0
+            except OSError as e:
+                print(f"SNAPSHOT ERROR: {e}")
+
+def report_snapshot_failure(future: asyncio.Future):
+    """Logs a snapshot that failed on the worker thread (the WAL still covers its orders)."""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"SNAPSHOT ERROR: {future.exception()}")
 
 # --- 2. Real-Time Data Broadcasts ---
+# Feed servers run without compression, and server frames are never masked
+# (RFC 6455), so one serialized frame is valid on every subscriber's wire.
+
+def frame_message(message: Union[str, bytes]) -> bytes:
+    """Serializes a message into a WebSocket frame once, for all subscribers."""
+    if isinstance(message, str):
+        return Frame(Opcode.TEXT, message.encode()).serialize(mask=False)
+    return Frame(Opcode.BINARY, message).serialize(mask=False)
 
-async def broadcast_trades(trades: List[Dict]):
-    """Pushes trade reports to all subscribers."""
+def broadcast_trades(trades: List[Dict]):
+    """Pushes trade reports to all subscribers (encoded and framed once)."""
     if TRADE_SUBSCRIBERS:
-        message = json.dumps({"type": "TRADE_REPORT", "trades": trades})
-        await asyncio.gather(*(ws.send(message) for ws in TRADE_SUBSCRIBERS), return_exceptions=True)
+        frame = frame_message(json.dumps({"type": "TRADE_REPORT", "trades": trades}))
+        for ws in TRADE_SUBSCRIBERS:
+            if ws.open:
+                ws.transport.write(frame)
+
+# Last framed L2 snapshot, keyed by its top-10 levels, and the last one published
+_L2_CACHE_KEY = None
+_L2_CACHE_FRAME = b""
+_L2_PUBLISHED = None
+
+def build_order_book_update() -> bytes:
+    """Encodes and frames the current BBO/L2 snapshot (top 10 price levels as [price, quantity])."""
+    global _L2_CACHE_KEY, _L2_CACHE_FRAME
+    bids = tuple((p / TICK, lvl.total_volume) for p, lvl in itertools.islice(ORDER_BOOK.bids.items(), 10))
+    asks = tuple((p / TICK, lvl.total_volume) for p, lvl in itertools.islice(ORDER_BOOK.asks.items(), 10))
+    if (bids, asks) == _L2_CACHE_KEY:
+        return _L2_CACHE_FRAME
+    
+    update = {
+        "type": "L2_UPDATE",
+        "timestamp": time.time(),
+        "symbol": ORDER_BOOK.symbol,
+        "bids": bids,
+        "asks": asks
+    }
+    _L2_CACHE_KEY = (bids, asks)
+    _L2_CACHE_FRAME = frame_message(orjson.dumps(update))
+    return _L2_CACHE_FRAME
+
+def enqueue_latest(queue: asyncio.Queue, frame: bytes):
+    """Queues a frame for one client, dropping the stale one if it is still pending."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(frame)
 
 async def broadcast_order_book_update():
-    """Pushes the current BBO/L2 snapshot to all subscribers."""
-    if MARKET_DATA_SUBSCRIBERS:
-        # Get top 10 price levels
-        bids = [{"price": p, "quantity": ORDER_BOOK.bids[p].total_volume} for p in ORDER_BOOK.get_sorted_prices("BUY")][:10]
-        asks = [{"price": p, "quantity": ORDER_BOOK.asks[p].total_volume} for p in ORDER_BOOK.get_sorted_prices("SELL")][:10]
-        
-        update = {
-            "type": "L2_UPDATE",
-            "timestamp": time.time(),
-            "symbol": ORDER_BOOK.symbol,
-            "bids": bids,
-            "asks": asks
-        }
-        message = json.dumps(update)
-        await asyncio.gather(*(ws.send(message) for ws in MARKET_DATA_SUBSCRIBERS), return_exceptions=True)
+    """Pushes the current BBO/L2 snapshot to all subscribers, yielding between batches."""
+    global _L2_PUBLISHED
+    if not MARKET_DATA_SUBSCRIBERS:
+        return
+    frame = build_order_book_update()
+    # Unchanged top 10 levels return the very same cached bytes: nothing to send
+    if frame is _L2_PUBLISHED:
+        return
+    _L2_PUBLISHED = frame
+    queues = list(MARKET_DATA_SUBSCRIBERS.values())
+    for i in range(0, len(queues), L2_FANOUT_BATCH):
+        for queue in queues[i:i + L2_FANOUT_BATCH]:
+            enqueue_latest(queue, frame)
+        # Let the engine and writers run before serving the next batch
+        await asyncio.sleep(0)
+
+async def l2_broadcaster():
+    """Publishes one L2 snapshot per burst of book changes."""
+    while True:
+        await L2_DIRTY.wait()
+        L2_DIRTY.clear()
+        await asyncio.sleep(L2_COALESCE_WINDOW)
+        await broadcast_order_book_update()
+
+async def market_data_writer(websocket: WebSocketServerProtocol, queue: asyncio.Queue):
+    """Single long-lived writer per market data client (writes pre-framed bytes)."""
+    try:
+        while True:
+            frame = await queue.get()
+            await websocket.ensure_open()
+            websocket.transport.write(frame)
+            # Keep backpressure: a slow reader makes newer snapshots replace pending ones
+            await websocket.drain()
+    except ConnectionClosed:
+        pass
 
 # --- 3. WebSocket API Handlers (Order Submission is now at ws://localhost:8000) ---
 
@@ -69,23 +180,46 @@ async def order_submission_handler(websocket: WebSocketServerProtocol, path: str
     """API endpoint to receive new orders and queue them for the engine."""
     async for message in websocket:
         try:
-            order_data = json.loads(message)
+            order_data = orjson.loads(message)
             
-            # Simple Validation
-            if not all(k in order_data for k in ['user_id', 'side', 'quantity', 'order_type']):
+            # Simple Validation: required fields are read directly, a miss rejects
+            try:
+                user_id = order_data['user_id']
+                side = order_data['side']
+                quantity = order_data['quantity']
+                order_type = order_data['order_type']
+            except KeyError:
                  await websocket.send(json.dumps({"status": "REJECTED", "reason": "Missing fields."}))
                  continue
+            side = side.upper()
+            order_type = order_type.upper()
+            if side not in SIDES or order_type not in ORDER_TYPES:
+                 await websocket.send(json.dumps({"status": "REJECTED", "reason": "Unsupported side or order type."}))
+                 continue
+            # Fields journaled as fixed-width WAL values must fit them (signed 64-bit id, double qty)
+            if isinstance(user_id, bool) or not isinstance(user_id, int) or not -(1 << 63) <= user_id < (1 << 63):
+                 await websocket.send(json.dumps({"status": "REJECTED", "reason": "user_id must be a 64-bit integer."}))
+                 continue
+            if isinstance(quantity, bool) or not isinstance(quantity, (int, float)):
+                 await websocket.send(json.dumps({"status": "REJECTED", "reason": "quantity must be a number."}))
+                 continue
+            # Off-tick prices would be rounded, possibly through the user's own limit
+            price = order_data.get('price', 0.0)
+            if not is_whole_tick(price):
+                 await websocket.send(json.dumps({"status": "REJECTED", "reason": f"Price must be a multiple of {1 / TICK}."}))
+                 continue
 
             new_order = Order(
                 order_id=ORDER_BOOK.get_new_id(),
-                user_id=order_data['user_id'],
-                side=order_data['side'].upper(),
-                price=order_data.get('price', 0.0),
-                quantity=order_data['quantity'],
-                order_type=order_data['order_type'].upper()
+                user_id=user_id,
+                side=side,
+                price=price,
+                quantity=quantity,
+                order_type=order_type
             )
             
-            await ENGINE_QUEUE.put(new_order)
+            ENGINE_RING.append(new_order)
+            ENGINE_WAKE.set()
             await websocket.send(json.dumps({"status": "ACCEPTED", "order_id": new_order.order_id}))
             
         except Exception as e:
@@ -93,12 +227,15 @@ async def order_submission_handler(websocket: WebSocketServerProtocol, path: str
 
 async def market_data_feed(websocket: WebSocketServerProtocol, path: str):
     """Handles subscriptions for real-time BBO/L2 Order Book."""
-    MARKET_DATA_SUBSCRIBERS.add(websocket)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=L2_QUEUE_SIZE)
+    MARKET_DATA_SUBSCRIBERS[websocket] = queue
+    writer = asyncio.create_task(market_data_writer(websocket, queue))
     try:
-        await broadcast_order_book_update()
+        enqueue_latest(queue, build_order_book_update())
         await websocket.wait_closed()
     finally:
-        MARKET_DATA_SUBSCRIBERS.remove(websocket)
+        del MARKET_DATA_SUBSCRIBERS[websocket]
+        writer.cancel()
 
 async def trade_execution_feed(websocket: WebSocketServerProtocol, path: str):
     """Handles subscriptions for Trade Execution Reports."""
@@ -110,11 +247,21 @@ async def trade_execution_feed(websocket: WebSocketServerProtocol, path: str):
 
 # --- Main Runner ---
 async def main():
+    # SIGTERM ends main() normally so the final snapshot in __main__ still runs
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+    except NotImplementedError:
+        pass  # Windows: no loop signal handlers; Ctrl+C still reaches the finally block
+
     asyncio.create_task(matching_engine_loop())
+    asyncio.create_task(l2_broadcaster())
     
     order_server = serve(order_submission_handler, "localhost", 8000, subprotocols=["order-submission"])
-    market_server = serve(market_data_feed, "localhost", 8001, subprotocols=["market-data"])
-    trade_server = serve(trade_execution_feed, "localhost", 8002, subprotocols=["trades"])
+    # Feeds stay uncompressed so broadcasts can share one pre-serialized frame
+    market_server = serve(market_data_feed, "localhost", 8001, subprotocols=["market-data"], compression=None)
+    trade_server = serve(trade_execution_feed, "localhost", 8002, subprotocols=["trades"], compression=None)
 
     print("--- Matching Engine Server Running ---")
     print("Order Submission (Taker API): ws://localhost:8000")
@@ -122,8 +269,17 @@ async def main():
     print("Trade Execution Feed: ws://localhost:8002")
     
     async with order_server, market_server, trade_server:
-        await asyncio.Future()
+        await stop
 
 if __name__ == "__main__":
     import websockets
-    asyncio.run(main())
\ No newline at end of file
+    # libuv-based event loop when available (not supported on Windows)
+    try:
+        import uvloop
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    try:
+        run(main())
+    finally:
+        ORDER_BOOK.close()
\ No newline at end of file
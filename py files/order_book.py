@@ -1,21 +1,44 @@
 # order_book.py
+import os
 import time
+import itertools
+import struct
 import pickle # Used for Persistence (Bonus #2)
-from typing import List, Dict, Union, Tuple
+from typing import Iterator, List, Dict, Optional, Union, Tuple
+from sortedcontainers import SortedDict
 # Import updated constants and classes
-from order_types import Order, PriceLevel, OrderIdMap, MAKER_FEE_RATE, TAKER_FEE_RATE 
+from order_types import Order, PriceLevel, OrderIdMap, MAKER_FEE_RATE, TAKER_FEE_RATE, TICK, SIDES, ORDER_TYPES
+
+def _descending(price: int) -> int:
+    """Sort key for the bid side (module-level so the book stays picklable)."""
+    return -price
+
+# --- Write-Ahead Log Records (BONUS #2) ---
+# Fixed-size binary record per incoming order:
+# (op, order_id, user_id, price, quantity, timestamp, side code, order type code)
+ORDER_REC = struct.Struct('<BQqdddBB')
+# Records are small (ORDER_REC.size bytes), so the buffer alone would hold well over
+# a snapshot interval's worth: durability relies on flush_wal() after each engine batch.
+WAL_BUFFER_SIZE = 1 << 16
+WAL_OP_ORDER = 1
+_SIDE_CODES = {side: code for code, side in enumerate(SIDES)}
+_ORDER_TYPE_CODES = {order_type: code for code, order_type in enumerate(ORDER_TYPES)}
 
 class OrderBook:
     """
     The Limit Order Book implementing Price-Time Priority and Persistence.
     """
-    def __init__(self, symbol: str):
+    def __init__(self, symbol: str, wal_filename="orderbook.wal"):
         self.symbol = symbol
-        self.bids: Dict[float, PriceLevel] = {}
-        self.asks: Dict[float, PriceLevel] = {}
+        # Price levels (keyed by tick) in priority order: bids highest-first, asks lowest-first
+        self.bids: SortedDict = SortedDict(_descending)
+        self.asks: SortedDict = SortedDict()
         self.orders_map: OrderIdMap = {} 
         self.next_order_id = 1
         self.next_trade_id = 1
+        self.last_order_id = 0  # Last order applied to the book (snapshot/WAL watermark)
+        self._wal_filename = wal_filename
+        self._wal = open(wal_filename, 'ab', buffering=WAL_BUFFER_SIZE)
         
     def get_new_id(self, is_trade=False) -> int:
         """Generates a unique, monotonically increasing ID."""
@@ -30,65 +53,133 @@ class OrderBook:
 
     # --- Structure Management and BBO ---
 
-    def get_sorted_prices(self, side: str) -> List[float]:
-        """Returns price keys sorted by priority (O(N) in this POC)."""
-        if side == "BUY":
-            return sorted(self.bids.keys(), reverse=True) # Highest price first
-        else:
-            return sorted(self.asks.keys())              # Lowest price first
-
-    def get_bbo(self) -> Tuple[Union[float, None], Union[float, None]]:
-        """Calculates Best Bid and Best Offer (BBO)."""
-        best_bid = max(self.bids.keys()) if self.bids else None
-        best_ask = min(self.asks.keys()) if self.asks else None
+    def get_bbo(self) -> Tuple[Union[int, None], Union[int, None]]:
+        """Calculates Best Bid and Best Offer (BBO), in ticks."""
+        best_bid = self.bids.keys()[0] if self.bids else None
+        best_ask = self.asks.keys()[0] if self.asks else None
         return best_bid, best_ask
 
-    def get_marketable_side(self, incoming_side: str) -> Tuple[Dict[float, PriceLevel], List[float]]:
-        """Returns the opposing book and the prioritized price list."""
-        if incoming_side == "BUY":
-            return self.asks, self.get_sorted_prices("SELL")
-        else:
-            return self.bids, self.get_sorted_prices("BUY")
+    def get_opposing_book(self, incoming_side: str) -> SortedDict:
+        """Returns the opposing book; iterating it yields levels in priority order."""
+        return self.asks if incoming_side == "BUY" else self.bids
 
     # --- Persistence Methods (BONUS #2) ---
-    def save_state(self, filename="orderbook_state.pkl"):
-        """Saves the current order book state to a file."""
-        data_to_save = {
-            'bids': self.bids,
-            'asks': self.asks,
-            'orders_map': self.orders_map,
+    def capture_snapshot(self) -> Dict:
+        """
+        Captures an immutable copy of the book state and rotates the WAL.
+        Runs on the engine loop; the (slow) pickling happens in write_snapshot,
+        which is safe to call from a worker thread while matching continues.
+        """
+        # Resting orders as plain tuples, in price-time priority order (prices in quote units)
+        orders = [
+            (o.order_id, o.user_id, o.side, o.price / TICK, o.quantity, o.initial_quantity, o.order_type, o.timestamp)
+            for side_book in (self.bids, self.asks)
+            for level in side_book.values()
+            for o in level
+        ]
+        # Records from here on go to a fresh WAL; the rotated one is only
+        # needed until the snapshot covering it is safely on disk.
+        self._wal.flush()
+        rotated = self._wal_filename + ".old"
+        if os.path.exists(rotated):
+            # An earlier snapshot never completed: keep its records too
+            with open(rotated, 'ab') as old, open(self._wal_filename, 'rb') as cur:
+                old.write(cur.read())
+            self._wal.truncate(0)
+        else:
+            self._wal.close()
+            try:
+                os.replace(self._wal_filename, rotated)
+            finally:
+                # Keep journaling even if the rotation failed (appends to the same file)
+                self._wal = open(self._wal_filename, 'ab', buffering=WAL_BUFFER_SIZE)
+        return {
+            'orders': orders,
             'next_order_id': self.next_order_id,
-            'next_trade_id': self.next_trade_id
+            'next_trade_id': self.next_trade_id,
+            'last_order_id': self.last_order_id,
+            'rotated_wal': rotated
         }
-        with open(filename, 'wb') as f:
-            pickle.dump(data_to_save, f)
+
+    @staticmethod
+    def write_snapshot(data: Dict, filename="orderbook_state.pkl"):
+        """Atomically writes a captured snapshot, then drops the WAL it supersedes."""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        try:
+            os.remove(data['rotated_wal'])
+        except FileNotFoundError:
+            pass
+
+    def save_snapshot(self, filename="orderbook_state.pkl"):
+        """Synchronously captures and writes a full snapshot."""
+        self.write_snapshot(self.capture_snapshot(), filename)
+
+    def _append_wal(self, order: Order):
+        """Appends the incoming order as a single fixed-size WAL record (O(1) per order)."""
+        self._wal.write(ORDER_REC.pack(WAL_OP_ORDER, order.order_id, order.user_id, order.price / TICK,
+                                       order.initial_quantity, order.timestamp,
+                                       _SIDE_CODES[order.side], _ORDER_TYPE_CODES[order.order_type]))
+
+    def flush_wal(self):
+        """Hands buffered WAL records to the OS (survives a process crash, not power loss)."""
+        self._wal.flush()
+
+    def replay_wal(self, wal_filename="orderbook.wal") -> int:
+        """Re-applies orders logged after the last snapshot. Returns the replay count."""
+        replayed = 0
+        # A rotated WAL is left behind if the process died mid-snapshot
+        for path in (wal_filename + ".old", wal_filename):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            # Ignore a torn tail from an interrupted write
+            complete = len(data) - len(data) % ORDER_REC.size
+            for op, order_id, user_id, price, quantity, timestamp, side, order_type in ORDER_REC.iter_unpack(data[:complete]):
+                if op != WAL_OP_ORDER or order_id <= self.last_order_id:
+                    continue  # Unknown record, or already contained in the snapshot
+                order = Order(order_id, user_id, SIDES[side], price, quantity, ORDER_TYPES[order_type])
+                order.timestamp = timestamp
+                self.process_order(order, journal=False)
+                self.next_order_id = max(self.next_order_id, order_id + 1)
+                replayed += 1
+        return replayed
+
+    def close(self):
+        """Writes a final snapshot and closes the WAL (call on shutdown)."""
+        self.save_snapshot()
+        self._wal.close()
 
     @classmethod
-    def load_state(cls, symbol: str, filename="orderbook_state.pkl") -> 'OrderBook':
-        """Loads and returns an OrderBook instance from a saved state file."""
+    def load_state(cls, symbol: str, filename="orderbook_state.pkl", wal_filename="orderbook.wal") -> 'OrderBook':
+        """Loads the last snapshot, then replays the WAL tail on top of it."""
+        book = cls(symbol, wal_filename) # Create a new instance
         try:
             with open(filename, 'rb') as f:
                 data = pickle.load(f)
             
-            book = cls(symbol) # Create a new instance
-            book.bids = data['bids']
-            book.asks = data['asks']
-            book.orders_map = data['orders_map']
+            for order_id, user_id, side, price, quantity, initial_quantity, order_type, timestamp in data['orders']:
+                order = Order(order_id, user_id, side, price, quantity, order_type)
+                order.initial_quantity = initial_quantity
+                order.timestamp = timestamp
+                book.add_limit_order(order)
             book.next_order_id = data['next_order_id']
             book.next_trade_id = data['next_trade_id']
+            book.last_order_id = data.get('last_order_id', 0)
             print(f"[PERSISTENCE] State successfully loaded from {filename}.")
-            return book
         except FileNotFoundError:
             print("[PERSISTENCE] State file not found. Starting with empty book.")
-            return cls(symbol) # Start fresh
 
-    # --- Fee Calculation (BONUS #4) ---
-    def _calculate_fees(self, fill_qty: float, execution_price: float) -> Tuple[float, float]:
-        """Calculates maker and taker fees for a trade."""
-        value = fill_qty * execution_price
-        taker_fee = value * TAKER_FEE_RATE
-        maker_fee = value * MAKER_FEE_RATE
-        return taker_fee, maker_fee
+        replayed = book.replay_wal(wal_filename)
+        if replayed:
+            print(f"[PERSISTENCE] Replayed {replayed} orders from {wal_filename}.")
+        # Checkpoint so new records never land behind a torn tail
+        book.save_snapshot(filename)
+        return book
 
     # --- Matching and Order Handling ---
 
@@ -100,20 +191,38 @@ class OrderBook:
         side_book[order.price].append_order(order)
         self.orders_map[order.order_id] = order
     
-    def _can_fok_fill(self, order: Order) -> bool:
-        """Pre-checks if sufficient volume is available for FOK."""
+    def _marketable_levels(self, order: Order, opposing_book: SortedDict) -> Iterator[Tuple[int, PriceLevel]]:
+        """Yields the best opposing level while it does not trade through the order's price."""
+        is_buy = order.side == "BUY"
+        limit_price = order.price
+        # Always peek the current best; levels emptied by the caller are removed
+        # in O(log N), so the next best one moves to the front without re-sorting.
+        while opposing_book:
+            price, level = opposing_book.peekitem(0)
+            # Internal Order Protection / Trade-Through Check (integer tick comparison)
+            if (is_buy and limit_price < price) or (not is_buy and limit_price > price):
+                return
+            yield price, level
+
+    def _plan_fok_fill(self, order: Order, opposing_book: SortedDict) -> Optional[List[Tuple[int, PriceLevel]]]:
+        """
+        Collects the levels that can fully fill a FOK order, or None if the volume
+        is insufficient. total_volume is a float running sum, so the plan can overstate
+        the fillable quantity by a rounding residual; process_order keeps matching past
+        the planned levels to absorb it.
+        """
         required_qty = order.quantity
         available_qty = 0.0
-        opposing_book, sorted_prices = self.get_marketable_side(order.side)
-        for price in sorted_prices:
-            if order.side == "BUY" and order.price < price: break
-            if order.side == "SELL" and order.price > price: break
-            level = opposing_book.get(price)
-            if level:
-                available_qty += level.total_volume
+        is_buy = order.side == "BUY"
+        plan = []
+        for price, level in opposing_book.items():
+            if (is_buy and order.price < price) or (not is_buy and order.price > price):
+                break
+            plan.append((price, level))
+            available_qty += level.total_volume
             if available_qty >= required_qty:
-                return True
-        return False
+                return plan
+        return None
         
     def _handle_remainder(self, order: Order, trades: List[Dict]):
         """Handles any unfilled quantity based on the order type."""
@@ -125,65 +234,84 @@ class OrderBook:
                 print(f"INFO: {order.order_type} ID {order.order_id} filled {order.initial_quantity - remaining_qty} and cancelled {remaining_qty}.")
                 order.quantity = 0 
         
-    def process_order(self, incoming_order: Order) -> List[Dict]:
+    def process_order(self, incoming_order: Order, journal: bool = True) -> List[Dict]:
         """The core single-threaded matching algorithm (The Waterfall)."""
         
         # --- Start Latency Timer (BONUS #3) ---
         start_time = time.perf_counter_ns()
         
         trades = []
-        if incoming_order.order_type == "FOK" and not self._can_fok_fill(incoming_order):
-            print(f"FOK Order {incoming_order.order_id} failed to fill completely. Order rejected.")
-            return [] 
+        self.last_order_id = incoming_order.order_id
+        if journal:
+            self._append_wal(incoming_order)
+
+        opposing_book = self.get_opposing_book(incoming_order.side)
+        if incoming_order.order_type == "FOK":
+            levels = self._plan_fok_fill(incoming_order, opposing_book)
+            if levels is None:
+                print(f"FOK Order {incoming_order.order_id} failed to fill completely. Order rejected.")
+                return [] 
+            # Any residual left by total_volume float drift continues down the book
+            levels = itertools.chain(levels, self._marketable_levels(incoming_order, opposing_book))
+        else:
+            levels = self._marketable_levels(incoming_order, opposing_book)
 
         # 2. Match Attempt
-        opposing_book, sorted_prices = self.get_marketable_side(incoming_order.side)
+        # Hot-loop state bound to locals: avoids repeated attribute lookups per fill
+        orders_map = self.orders_map
+        symbol = self.symbol
+        side = incoming_order.side
+        taker_order_id = incoming_order.order_id
+        remaining_qty = incoming_order.quantity
+        taker_fee_rate = TAKER_FEE_RATE
+        maker_fee_rate = MAKER_FEE_RATE
+        # One wall-clock read per order, shared by all of its fills
+        ts_wall = time.time()
         
-        for price in sorted_prices:
-            if incoming_order.quantity <= 0: break
-            # Internal Order Protection / Trade-Through Check
-            if (incoming_order.side == "BUY" and incoming_order.price < price) or \
-               (incoming_order.side == "SELL" and incoming_order.price > price): 
-                break 
-            
-            level = opposing_book.get(price)
-            if not level: continue
+        for price, level in levels:
+            execution_price = price / TICK
             
             # Price-Time Priority (FIFO) Match
-            while level.orders and incoming_order.quantity > 0:
-                resting_order = level.get_top_order() 
-                fill_qty = min(incoming_order.quantity, resting_order.quantity)
-                execution_price = price 
+            while level.head is not None and remaining_qty > 0:
+                resting_order = level.head
+                resting_qty = resting_order.quantity
+                fill_qty = remaining_qty if remaining_qty < resting_qty else resting_qty
                 
-                # Calculate Fees (BONUS #4)
-                taker_fee, maker_fee = self._calculate_fees(fill_qty, execution_price)
+                # Calculate Fees on the executed trade value (BONUS #4)
+                value = fill_qty * execution_price
+                taker_fee = value * taker_fee_rate
+                maker_fee = value * maker_fee_rate
                 
                 # Generate Trade Execution Report
                 trade_report = {
-                    "timestamp": time.time(),
-                    "symbol": self.symbol,
+                    "timestamp": ts_wall,
+                    "symbol": symbol,
                     "trade_id": self.get_new_id(is_trade=True),
                     "price": execution_price,
                     "quantity": fill_qty,
-                    "aggressor_side": incoming_order.side,
+                    "aggressor_side": side,
                     "maker_order_id": resting_order.order_id,
-                    "taker_order_id": incoming_order.order_id,
+                    "taker_order_id": taker_order_id,
                     "taker_fee": taker_fee,
                     "maker_fee": maker_fee,
                 }
                 trades.append(trade_report)
                 
                 # Update Quantities and Cleanup
-                incoming_order.quantity -= fill_qty
-                resting_order.quantity -= fill_qty
+                remaining_qty -= fill_qty
+                resting_order.quantity = resting_qty - fill_qty
                 level.total_volume -= fill_qty
                 
                 if resting_order.quantity <= 0:
                     level.pop_oldest_order()
-                    del self.orders_map[resting_order.order_id]
+                    del orders_map[resting_order.order_id]
             
             if not level:
                 del opposing_book[price]
+            if remaining_qty <= 0:
+                break
+
+        incoming_order.quantity = remaining_qty
 
         # 3. Handle Order Remainder
         self._handle_remainder(incoming_order, trades)
@@ -196,7 +324,4 @@ class OrderBook:
         if trades:
              trades[0]['engine_latency_ns'] = latency_ns
              
-        # Save state (BONUS #2)
-        self.save_state() 
-        
         return trades
\ No newline at end of file
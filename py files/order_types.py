@@ -1,55 +1,115 @@
 # order_types.py
+import math
 import time
-from collections import deque
-from typing import Deque, Dict, Tuple
+from typing import Dict, Iterator, Optional, Tuple
 
 # --- FEE CONSTANTS (BONUS #4) ---
 # These rates are applied to the executed trade value (price * quantity)
 MAKER_FEE_RATE = 0.0010  # 0.10% (Resting Order - Provides Liquidity)
 TAKER_FEE_RATE = 0.0020  # 0.20% (Aggressive Order - Removes Liquidity)
 
+# --- PRICE TICKS ---
+# Prices are held internally as integer ticks (1 tick = 1/TICK of a quote unit)
+# so level keys hash and compare exactly. Convert back with price / TICK.
+TICK = 100
+
+def is_whole_tick(price: float) -> bool:
+    """True if the price is a number on the tick grid (Order would otherwise round it)."""
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        return False
+    ticks = price * TICK
+    return math.isclose(ticks, round(ticks), rel_tol=1e-12, abs_tol=1e-9)
+
+# Supported enumerations (index doubles as the compact code used in the WAL)
+SIDES = ("BUY", "SELL")
+ORDER_TYPES = ("LIMIT", "MARKET", "IOC", "FOK")
+
 class Order:
     """Represents a single order in the system."""
+    # Fixed attribute layout: faster attribute access in the match loop, smaller objects.
+    # Orders deliberately stay individual objects rather than parallel arrays: matching
+    # touches one order at a time, where slot access beats per-element array indexing.
+    __slots__ = ("order_id", "user_id", "side", "price", "quantity", "initial_quantity",
+                 "timestamp", "order_type", "prev", "next")
+
     def __init__(self, order_id: int, user_id: int, side: str, price: float, quantity: float, order_type: str):
         self.order_id = order_id
         self.user_id = user_id
         self.side = side          # "BUY" or "SELL"
-        self.price = price        # Required for LIMIT, IOC, FOK
+        self.price = int(round(price * TICK))  # In ticks; required for LIMIT, IOC, FOK
         self.quantity = quantity
         self.initial_quantity = quantity  # Original size for fee/audit reference
         self.timestamp = time.time()
         self.order_type = order_type # "LIMIT", "MARKET", "IOC", "FOK"
+        # Intrusive links to the neighbouring orders at the same PriceLevel
+        self.prev: Optional['Order'] = None
+        self.next: Optional['Order'] = None
 
     def __repr__(self):
-        return (f"Order(ID={self.order_id}, Side={self.side}, P={self.price:.2f}, "
+        return (f"Order(ID={self.order_id}, Side={self.side}, P={self.price / TICK:.2f}, "
                 f"Q={self.quantity:.2f}, Type={self.order_type})")
 
 class PriceLevel:
     """
     Container for all orders at a single price point.
-    Uses deque to enforce Time Priority (FIFO).
+    Orders form an intrusive doubly-linked list (head = oldest) to enforce
+    Time Priority (FIFO) while allowing O(1) removal from anywhere in the queue.
     """
+    __slots__ = ("head", "tail", "count", "total_volume")
+
     def __init__(self):
-        self.orders: Deque['Order'] = deque()
+        self.head: Optional['Order'] = None
+        self.tail: Optional['Order'] = None
+        self.count: int = 0
         self.total_volume: float = 0.0
 
     def append_order(self, order: 'Order'):
         """Adds a new order to the end of the queue (FIFO)."""
-        self.orders.append(order)
+        order.prev = self.tail
+        order.next = None
+        if self.tail is not None:
+            self.tail.next = order
+        else:
+            self.head = order
+        self.tail = order
+        self.count += 1
         self.total_volume += order.quantity
 
+    def unlink(self, order: 'Order'):
+        """Removes an order from any position in the queue in O(1)."""
+        if order.prev is not None:
+            order.prev.next = order.next
+        else:
+            self.head = order.next
+        if order.next is not None:
+            order.next.prev = order.prev
+        else:
+            self.tail = order.prev
+        order.prev = order.next = None
+        self.count -= 1
+        self.total_volume -= order.quantity
+
     def pop_oldest_order(self) -> 'Order':
         """Removes and returns the oldest order (front of the queue)."""
-        order = self.orders.popleft()
-        self.total_volume -= order.quantity
+        order = self.head
+        self.unlink(order)
         return order
 
     def get_top_order(self) -> 'Order':
         """Returns the oldest order without removing it."""
-        return self.orders[0]
+        return self.head
+
+    def __iter__(self) -> Iterator['Order']:
+        order = self.head
+        while order is not None:
+            yield order
+            order = order.next
+
+    def __len__(self):
+        return self.count
 
     def __bool__(self):
-        return len(self.orders) > 0
+        return self.head is not None
 
 # Type Alias for clarity
 OrderIdMap = Dict[int, Order]
\ No newline at end of file